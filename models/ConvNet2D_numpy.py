@@ -1,8 +1,32 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+try:
+    import numba
+except ImportError:  # numba is optional, without it the loop kernels at the end of this file run as plain Python
+    numba = None
+
+
+def get_array_module(device):
+    """Returns the array module for device: numpy for 'cpu', cupy for 'cuda'"""
+    assert device in ['cpu', 'cuda']
+    if device == 'cuda':
+        import cupy  # optional, only needed to run on the GPU
+        return cupy
+    return np
+
+
+def as_strided_readonly(xp, x, shape, strides):
+    """Strided view of x that cannot be written to; cupy's as_strided has no writeable argument, so its views stay writeable"""
+    if xp is np:
+        return np.lib.stride_tricks.as_strided(x, shape=shape, strides=strides, writeable=False)
+    return xp.lib.stride_tricks.as_strided(x, shape=shape, strides=strides)
+
 class ConvNet2D:
     def __init__(self, in_channels, out_channels, num_filters, filter_sizes, strides, paddings, pooling = None,
-                 pool_sizes=None, pooling_strides=None):
+                 pool_sizes=None, pooling_strides=None, dtype=np.float32, device='cpu'):
         """CNN classifier with parameterizable number of convolutional layers and pooling layers, and a fully connected layer
         
         Arguments:
@@ -15,6 +39,8 @@ class ConvNet2D:
         pooling -- Pooling type ('max' or 'average') or None
         pool_sizes -- List of pooling sizes in each pooling layer
         pooling_strides -- List of pooling strides in each pooling layer    
+        dtype -- Floating point type of the parameters, activations and gradients. Default: np.float32
+        device -- 'cpu' (numpy) or 'cuda' (cupy). Default: 'cpu'
         """
 
         self.in_channels = in_channels
@@ -26,6 +52,9 @@ class ConvNet2D:
         self.pooling = pooling
         self.pool_sizes = pool_sizes
         self.pooling_strides = pooling_strides
+        self.dtype = dtype
+        self.device = device
+        self.xp = get_array_module(device)
 
         assert len(num_filters) == len(filter_sizes) == len(strides) == len(paddings)
         assert pooling is None or (pool_sizes is not None and len(pool_sizes) == len(num_filters))
@@ -34,39 +63,56 @@ class ConvNet2D:
         self.pooling_layers = []
 
         for i in range(len(num_filters)):
-            self.conv_layers.append(Conv2d(in_channels, num_filters[i], filter_sizes[i], strides[i], paddings[i]))
+            self.conv_layers.append(Conv2d(in_channels, num_filters[i], filter_sizes[i], strides[i], paddings[i], dtype, device))
             in_channels = num_filters[i]  # Update in_channels for next layer
 
             if pooling is not None and pool_sizes[i]:
-                self.pooling_layers.append(Pooling(pool_sizes[i], pooling_strides[i], pooling))
+                self.pooling_layers.append(Pooling(pool_sizes[i], pooling_strides[i], pooling, device))
 
-        self.fc = None # initialized in foward pass because we don't know the input size yet
+        self.fc = None # initialized by initialize_parameters() because we don't know the input size yet
 
 
-    def forward(self, A):
+    def initialize_parameters(self, input_shape):
+        """Initialize the fully connected layer, whose input size is found with a dry forward pass of one example
+        Arguments:
+        input_shape -- Shape of the input data (m, n_H, n_W, n_C)
+        """
+        A = self.xp.zeros((1,) + tuple(input_shape[1:]), dtype=self.dtype)
+        for i in range(len(self.conv_layers)):
+            A = self.conv_layers[i].forward(A, training=False)[0]
+            if len(self.pooling_layers) > 0:
+                A = self.pooling_layers[i].forward(A, training=False)[0]
+
+        self.fc = FullyConnected(A.size, self.out_channels, self.dtype, self.device)
+
+
+    def forward(self, A, training=True):
         """Forward pass through the CNN
         Arguments:
         A -- Input data of shape (m, n_H, n_W, n_C)
+        training -- whether backward() will be called with the caches. Default: True
         Returns:
         A -- Output of the fully connected layer, shape (n_y, m)
         caches -- List of caches for each layer
+        With training, the caches share buffers with the layers, they are only valid until the next training forward call
         """
         caches = []
+        A = self.xp.asarray(A, dtype=self.dtype)  # move and cast the input once, every layer then computes in self.dtype
 
         # Forward pass through convolutional + pooling layers
         for i in range(len(self.conv_layers)):
-            A, (cache_conv, cache_activation) = self.conv_layers[i].forward(A)
+            A, (cache_conv, cache_activation) = self.conv_layers[i].forward(A, training)
             caches.append((cache_conv, cache_activation)) 
 
             if len(self.pooling_layers) > 0:
-                A, cache_pool = self.pooling_layers[i].forward(A)
+                A, cache_pool = self.pooling_layers[i].forward(A, training)
                 caches.append(cache_pool)  
 
         # Flatten feature map for fully connected layer
         A = A.reshape(A.shape[0], -1).T  # (n_x, m)
-        # Initialize fully connected layer only the first time
+        # Initialize fully connected layer only the first time, if fit() did not already do it
         if self.fc is None:
-            self.fc = FullyConnected(A.shape[0], self.out_channels)
+            self.fc = FullyConnected(A.shape[0], self.out_channels, self.dtype, self.device)
         A, (fc_linear_cache, fc_activation_cache) = self.fc.forward(A)
         caches.append((fc_linear_cache, fc_activation_cache))  
 
@@ -88,7 +134,7 @@ class ConvNet2D:
 
         # Backprop through fully connected layer
         fc_linear_cache, fc_activation_cache = caches.pop()
-        Y = Y.reshape(AL.shape)  # Ensure correct shape
+        Y = self.xp.asarray(Y, dtype=AL.dtype).reshape(AL.shape)  # Ensure correct device, dtype and shape
         dA, dW, db = self.fc.backward(AL, Y, (fc_linear_cache, fc_activation_cache))
 
         grads['dW'] = dW
@@ -124,7 +170,7 @@ class ConvNet2D:
         v = beta2 * v + (1 - beta2) * (dtheta ** 2)
         m_hat = m / (1 - beta1 ** t)
         v_hat = v / (1 - beta2 ** t)
-        theta -= learning_rate * m_hat / (np.sqrt(v_hat) + epsilon)
+        theta -= learning_rate * m_hat / (v_hat ** 0.5 + epsilon)
         return theta, m, v
 
     def compute_cost(self, AL, Y):
@@ -137,7 +183,7 @@ class ConvNet2D:
         '''
     
         m = Y.shape[1]
-        cost = -np.sum(Y * np.log(AL + 1e-9)) / m
+        cost = -self.xp.sum(Y * self.xp.log(AL + 1e-9)) / m
         return cost
 
     def fit(self, X, Y, learning_rate=0.01, n_iters=1000, seed=0):
@@ -158,9 +204,15 @@ class ConvNet2D:
 
         assert Y.shape[1] == self.out_channels
 
+        # move and cast once instead of in every forward pass, compute_cost() needs Y on the device too
+        X = self.xp.asarray(X, dtype=self.dtype)
+        Y = self.xp.asarray(Y, dtype=self.dtype)
+        if self.fc is None:
+            self.initialize_parameters(X.shape)
+
         for i in range(n_iters):
             AL, cache = self.forward(X)
-            cost = self.compute_cost(AL, Y.T)
+            cost = float(self.compute_cost(AL, Y.T))
             grads = self.backward(cache, AL, Y.T)
             self.update_parameters_adam(grads, learning_rate, t=i+1)
             costs.append(cost)
@@ -171,17 +223,48 @@ class ConvNet2D:
 
     def predict(self, X):
         """Returns the predicted class index for each sample.
+        Runs an inference forward pass, which leaves the layers' buffers, and so any pending training caches, untouched
         Arguments:
         X -- Input data of shape (m, n_H, n_W, n_C)
         Returns:
         Predictions -- Array of predicted class indices
         """
-        probs = self.forward(X)[0]
-        return np.argmax(probs, axis=0)
+        probs = self.forward(X, training=False)[0]
+        predictions = self.xp.argmax(probs, axis=0)
+        return predictions if self.xp is np else self.xp.asnumpy(predictions)
 
 class Conv2d:
 
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0):
+    # Winograd F(4x4, 3x3) transforms: Y = A^T [(G g G^T) * (B^T d B)] A for a 6x6 input tile d and a 3x3 filter g
+    WINOGRAD_G = np.array([[1 / 4, 0, 0],
+                           [-1 / 6, -1 / 6, -1 / 6],
+                           [-1 / 6, 1 / 6, -1 / 6],
+                           [1 / 24, 1 / 12, 1 / 6],
+                           [1 / 24, -1 / 12, 1 / 6],
+                           [0, 0, 1]])  # (6, 3)
+    WINOGRAD_B = np.array([[4, 0, -5, 0, 1, 0],
+                           [0, -4, -4, 1, 1, 0],
+                           [0, 4, -4, -1, 1, 0],
+                           [0, -2, -1, 2, 1, 0],
+                           [0, 2, -1, -2, 1, 0],
+                           [0, 4, 0, -5, 0, 1]]).T  # (6, 6)
+    WINOGRAD_A = np.array([[1, 1, 1, 1, 1, 0],
+                           [0, 1, -1, 2, -2, 0],
+                           [0, 1, 1, 4, 4, 0],
+                           [0, 1, -1, 8, -8, 1]]).T  # (6, 4)
+
+    # The Winograd path only beats the im2col GEMM with many channels (measured from 64 -> 64 channels up),
+    # and only without a backward pass, which needs the unrolled slices anyway
+    WINOGRAD_MIN_CHANNELS = 64 * 64  # minimum n_C_prev * n_C
+
+    # Above this size the unrolled (m*n_H*n_W, f*f*n_C_prev) matrix is not built for the whole batch: the batch is
+    # unrolled in threaded sub-batches that fit in this budget, or when a single example does not fit, convolved
+    # by the numba loop kernels (plain Python kernels would be far slower than sub-batches of one example)
+    IM2COL_MAX_BYTES = 2 ** 30
+    # Each sub-batch GEMM is already multithreaded by BLAS, the few threads mostly overlap the im2col copies with the GEMMs
+    SUB_BATCH_MAX_WORKERS = 4
+
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, dtype=np.float32, device='cpu'):
         """
         Applies a 2D convolution over an input signal composed of several input planes.
 
@@ -191,70 +274,106 @@ class Conv2d:
         kernel_size -- Size of the convolving kernel
         stride -- Stride of the convolution. Default: 1
         padding -- Zero-padding added to both sides of the input. Int or 'valid' or 'same'. Default: 0
+        dtype -- Floating point type of the weights and biases. Default: np.float32
+        device -- 'cpu' (numpy) or 'cuda' (cupy). Default: 'cpu'
         """
 
         self.in_channels = in_channels
         self.kernel_size = kernel_size
         self.n_filters = out_channels
         self.hparameters = {"stride": stride, "pad": padding}
-        # each filter fxf with n_C_prev channels will produce one output channel
-        self.W = np.random.randn(kernel_size, kernel_size, in_channels, out_channels) * np.sqrt(2. / (kernel_size * kernel_size * in_channels))  # (f, f, n_C_prev, n_C) 
+        self.device = device
+        self.xp = get_array_module(device)
+        # each filter fxf with n_C_prev channels will produce one output channel, stored contiguously (OIHW layout)
+        self.W = self.xp.asarray(np.random.randn(out_channels, in_channels, kernel_size, kernel_size) * np.sqrt(2. / (kernel_size * kernel_size * in_channels)), dtype=dtype)  # (n_C, n_C_prev, f, f)
         # each filter will have one bias
-        self.b = np.zeros((1, 1, 1, out_channels))  # (1, 1, 1, n_C)
+        self.b = self.xp.zeros((1, 1, 1, out_channels), dtype=dtype)  # (1, 1, 1, n_C)
 
 
-        self.W_m, self.W_v = np.zeros_like(self.W), np.zeros_like(self.W)
-        self.b_m, self.b_v = np.zeros_like(self.b), np.zeros_like(self.b)
+        self.W_m, self.W_v = self.xp.zeros_like(self.W), self.xp.zeros_like(self.W)
+        self.b_m, self.b_v = self.xp.zeros_like(self.b), self.xp.zeros_like(self.b)
 
-    @staticmethod
-    def ReLU(Z):
-        """ReLU activation function"""
-        return np.maximum(0, Z)
+        self._pad_buf = None  # padded input, reused while the input shape does not change
+        self._A_buf = None  # im2col GEMM output, activated in place and reused while the output shape does not change
+        self._im2col_cache = None  # last (input shape, input strides, f, stride) and the (shape, strides) of its slices view
+        self._U, self._U_W = None, None  # Winograd transform of W and a copy of the W it was computed from
 
+    def ReLU(self, Z, out=None):
+        """ReLU activation function, computed in place when out is Z"""
+        return self.xp.maximum(Z, 0, out=out)
 
-    @staticmethod
-    def zero_pad(X, pad):
+
+    def zero_pad(self, X, pad, reuse_buffer=True):
         """
-        Pad with zeros all 2D data of the dataset X. The padding is applied to both dimensions
+        Pad with zeros all 2D data of the dataset X. The padding is applied to both dimensions.
+        With reuse_buffer, the padded array is a buffer owned by the layer: it is only allocated when the shape of X
+        changes, otherwise its interior is overwritten, so it is only valid until the next call with reuse_buffer.
 
         Arguments:
         X -- python numpy array of shape (m, n_H, n_W, n_C) representing a batch of m 2D objects
         pad -- integer, amount of padding around each object on both dimensions
+        reuse_buffer -- whether to pad into the layer's buffer or into a new array. Default: True
 
         Returns:
         X_pad -- padded object of shape (m, n_H + 2*pad, n_W + 2*pad, n_C)
         """
-        return np.pad(X, ((0, 0), (pad, pad), (pad, pad), (0, 0)), 'constant', constant_values=(0, 0))
+        if pad == 0:
+            return X
 
-    @staticmethod 
-    def conv_single_step(slice, W, b):
+        (m, n_H, n_W, n_C) = X.shape
+        shape = (m, n_H + 2 * pad, n_W + 2 * pad, n_C)
+        if not reuse_buffer:
+            X_pad = self.xp.zeros(shape, dtype=X.dtype)
+        else:
+            if self._pad_buf is None or self._pad_buf.shape != shape or self._pad_buf.dtype != X.dtype:
+                self._pad_buf = self.xp.zeros(shape, dtype=X.dtype)
+            X_pad = self._pad_buf
+        # the border is never written to, so it stays zero
+        X_pad[:, pad:pad + n_H, pad:pad + n_W, :] = X
+        return X_pad
+
+    def _im2col(self, A_prev_pad, f, stride, n_H, n_W):
         """
-        Apply one filter defined by parameters W on a single slice (slice) of the output activation of the previous layer.
+        Unroll all the (f, f, n_C_prev) slices of A_prev_pad into the rows of a matrix.
 
         Arguments:
-        slice -- slice of input data of shape (f, f, n_C_prev)
-        W -- Weight parameters contained in a window - matrix of shape (f, f, n_C_prev)
-        b -- Bias parameters contained in a window - matrix of shape (1, 1, 1)
+        A_prev_pad -- padded input, numpy array of shape (m, n_H_prev + 2*pad, n_W_prev + 2*pad, n_C_prev)
+        f -- size of the convolving kernel
+        stride -- stride of the convolution
+        n_H, n_W -- dimensions of the output volume
 
         Returns:
-        Z -- a scalar value, result of convolving the sliding window (W, b) on a slice x of the input data
+        cols -- numpy array of shape (m*n_H*n_W, n_C_prev*f*f), one slice per row, ordered like a filter of W
         """
-        return np.sum(np.multiply(slice, W)) + b
-
-
-
-    def forward(self, A_prev):
+        # The view descriptor only depends on the input layout, so it is only recomputed when that layout changes.
+        # Only the last one is kept, which covers the fixed-shape training loop without growing with every batch size
+        key = (A_prev_pad.shape, A_prev_pad.strides, f, stride)
+        cache = self._im2col_cache  # read once, the sub-batch threads may replace it concurrently
+        if cache is None or cache[0] != key:
+            m, n_C_prev = A_prev_pad.shape[0], A_prev_pad.shape[3]
+            s0, s1, s2, s3 = A_prev_pad.strides
+            cache = (key, ((m, n_H, n_W, n_C_prev, f, f), (s0, stride * s1, stride * s2, s3, s1, s2)))
+            self._im2col_cache = cache
+        shape, strides = cache[1]
+
+        # view of shape (m, n_H, n_W, n_C_prev, f, f) over the padded input, no data is copied here
+        slices = as_strided_readonly(self.xp, A_prev_pad, shape, strides)
+        return slices.reshape(-1, shape[3] * f * f)
+
+    def forward(self, A_prev, training=True):
         """
         Implements the forward propagation for a convolution function
         
         Arguments:
         A_prev -- output activations of the previous layer (m, n_H_prev, n_W_prev, n_C_prev)
-        W -- Weights, numpy array of shape (f, f, n_C_prev, n_C)
+        training -- whether backward() will be called on the output. Default: True
+                    Only training passes reuse the layer's buffers, so inference never overwrites a training pass
+        W -- Weights, numpy array of shape (n_C, n_C_prev, f, f)
         b -- Biases, numpy array of shape (1, 1, 1, n_C)
         hparameters -- python dictionary containing "stride" and "pad"
             
         Returns:
-        A -- conv output, numpy array of shape (m, n_H, n_W, n_C)
+        A -- conv output, numpy array of shape (m, n_H, n_W, n_C), overwritten by the next training call
         cache -- cache of values needed for the conv_backward() function
         """
         
@@ -262,7 +381,7 @@ class Conv2d:
         (m, n_H_prev, n_W_prev, n_C_prev) = A_prev.shape
 
         # Retrieve dimensions from W's shape
-        (f, f, n_C_prev, n_C) = self.W.shape
+        (n_C, n_C_prev, f, f) = self.W.shape
 
         stride = self.hparameters["stride"]
         pad = self.hparameters["pad"]
@@ -276,46 +395,139 @@ class Conv2d:
             pass # Assume padding is an integer
 
         # Padding the A_prev
-        A_prev_pad = self.zero_pad(A_prev, pad)
+        A_prev_pad = self.zero_pad(A_prev, pad, reuse_buffer=training)
 
         # Compute the dimensions of the CONV output volume using the formula. 
         n_H = int(np.floor((n_H_prev - f + 2 * pad) / stride) + 1)
         n_W = int(np.floor((n_W_prev - f + 2 * pad) / stride) + 1)
 
-        # Initialize the output volume A (Z after activation) and Z with zeros
-        Z = np.zeros((m, n_H, n_W, n_C))
-        A = np.zeros((m, n_H, n_W, n_C))
+        if (not training and self.device == 'cpu' and f == 3 and stride == 1 and n_H % 4 == 0 and n_W % 4 == 0
+                and n_C_prev * n_C >= self.WINOGRAD_MIN_CHANNELS):
+            # At inference, 3x3 stride 1 convolutions with many channels whose output splits into 4x4 tiles
+            # take the Winograd path, backward() would rebuild the unrolled slices if it were called anyway
+            Z = self.forward_winograd(A_prev_pad, n_H, n_W)
+            cols = None
+        elif self.device == 'cpu' and m * n_H * n_W * f * f * n_C_prev * A_prev_pad.itemsize > self.IM2COL_MAX_BYTES:
+            # The unrolled slices would not fit in memory: unroll a few examples at a time in parallel threads,
+            # or convolve the slices one by one with the loop kernel if even one example is too large
+            if numba is not None and n_H * n_W * f * f * n_C_prev * A_prev_pad.itemsize > self.IM2COL_MAX_BYTES:
+                Z = _conv_forward_nb(A_prev_pad, np.ascontiguousarray(self.W.reshape(n_C, -1).T), self.b.reshape(n_C), f, stride, n_H, n_W)
+            else:
+                Z = self._forward_sub_batches(A_prev_pad, f, stride, n_H, n_W)
+            cols = None
+        else:
+            # Unroll every receptive field into a row: (m*n_H*n_W, n_C_prev*f*f)
+            cols = self._im2col(A_prev_pad, f, stride, n_H, n_W)
+            # Each filter becomes a row, no data is copied: (n_C, n_C_prev*f*f)
+            Wmat = self.W.reshape(n_C, -1)
+
+            # Convolve all the slices with all the filters at once (single GEMM), into the reused output buffer when training
+            dtype = self.xp.result_type(cols, Wmat)
+            if not training:
+                out = self.xp.empty((cols.shape[0], n_C), dtype=dtype)
+            else:
+                if self._A_buf is None or self._A_buf.shape != (cols.shape[0], n_C) or self._A_buf.dtype != dtype:
+                    self._A_buf = self.xp.empty((cols.shape[0], n_C), dtype=dtype)
+                out = self._A_buf
+            Z = self.xp.dot(cols, Wmat.T, out=out)
+            # Add the biases
+            Z += self.b.reshape(1, n_C)
+            Z = Z.reshape(m, n_H, n_W, n_C)
+        # Activation, in place: A takes over Z's memory, backward only needs to know where Z > 0
+        A = self.ReLU(Z, out=Z)
+        if not training:
+            # backward() will not be called, so neither the mask nor the unrolled slices are kept
+            return A, ((A_prev, self.W, self.b, self.hparameters, None), None)
+        # Keep that mask packed, 1 bit per activation
+        mask = (self.xp.packbits((A > 0).ravel()), A.shape)
+
+        # Save information in "cache" for the backprop, the parameters are only updated after backward so they are not copied
+        conv_cache = (A_prev, self.W, self.b, self.hparameters, cols)
+        activation_cache = mask
 
-        for i in range(m):               # loop training examples
-            A_prev_pad_i = A_prev_pad[i]     
-            for h in range(n_H):           # loop over vertical axis of the output volume
-                #Find the vertical start and end of the current "slice"
-                vert_start = h * stride
-                vert_end = vert_start + f
+        return A, (conv_cache, activation_cache)
 
-                for w in range(n_W):       # loop over horizontal axis of the output volume
-                    #Find the horizontal start and end of the current "slice"
-                    horiz_start = w * stride
-                    horiz_end = horiz_start + f
+    def forward_winograd(self, A_prev_pad, n_H, n_W):
+        """
+        Implements the linear part of the forward propagation for a 3x3, stride 1 convolution with Winograd F(4x4, 3x3).
+        The 36 channel reductions run as one batched matmul, but the transforms around it make this slower
+        than the im2col GEMM unless there are many channels (see WINOGRAD_MIN_CHANNELS)
 
-                    for c in range(n_C):   # loop over channels (= #filters) of the output volume
+        Arguments:
+        A_prev_pad -- padded input, numpy array of shape (m, n_H + 2, n_W + 2, n_C_prev)
+        n_H, n_W -- dimensions of the output volume, both multiples of 4
+
+        Returns:
+        Z -- conv output before the activation, numpy array of shape (m, n_H, n_W, n_C)
+        """
+        G, B, A = (T.astype(A_prev_pad.dtype) for T in (self.WINOGRAD_G, self.WINOGRAD_B, self.WINOGRAD_A))
+        m, n_C_prev = A_prev_pad.shape[0], A_prev_pad.shape[3]
+        n_C = self.W.shape[0]
+        n_tH, n_tW = n_H // 4, n_W // 4
+
+        # Filter transform G g G^T, one (n_C_prev, n_C) matrix per tile position: (36, n_C_prev, n_C)
+        # The transform is only recomputed when W differs from the W it was computed from, or the input dtype changed.
+        # Comparing the values of W is much cheaper than the transform and catches any change, in place or by assignment
+        if self._U is None or self._U.dtype != A_prev_pad.dtype or not np.array_equal(self._U_W, self.W):
+            self._U = np.einsum('ij,ncjk,lk->ilcn', G, self.W, G, optimize=True).reshape(36, n_C_prev, n_C)
+            self._U_W = self.W.copy()
+        U = self._U
+
+        # 6x6 input tiles overlapping by 2, one per 4x4 output tile: (m, n_tH, n_tW, 6, 6, n_C_prev)
+        s0, s1, s2, s3 = A_prev_pad.strides
+        tiles = np.lib.stride_tricks.as_strided(A_prev_pad, shape=(m, n_tH, n_tW, 6, 6, n_C_prev),
+                                                strides=(s0, 4 * s1, 4 * s2, s1, s2, s3), writeable=False)
+        # Input transform B^T d B, one (m*n_tH*n_tW, n_C_prev) matrix per tile position: (36, m*n_tH*n_tW, n_C_prev)
+        V = np.einsum('ai,mhwabc,bj->ijmhwc', B, tiles, B, optimize=True).reshape(36, -1, n_C_prev)
+
+        # Element-wise product in the Winograd domain reduced over the input channels: 36 GEMMs in one batched matmul
+        M = np.matmul(V, U).reshape(6, 6, m, n_tH, n_tW, n_C)
+
+        # Output transform A^T M A, then stitch the 4x4 tiles back together
+        Y = np.einsum('ai,abmhwn,bj->mhwijn', A, M, A, optimize=True)
+        Z = Y.transpose(0, 1, 3, 2, 4, 5).reshape(m, n_H, n_W, n_C)
+
+        return Z + self.b
+
+    def _sub_batches(self, m, bytes_per_example):
+        """Splits range(m) into slices small enough for the sub-batches run at the same time to fit in IM2COL_MAX_BYTES,
+        bytes_per_example being the size of the per-example temporaries (cols, and dcols in backward).
+        Returns the slices and the number of threads to run them on, at most the number of sub-batches needed"""
+        n_needed = -(-m * bytes_per_example // self.IM2COL_MAX_BYTES)
+        n_workers = max(1, min(self.SUB_BATCH_MAX_WORKERS, os.cpu_count() or 1, n_needed))
+        size = max(1, self.IM2COL_MAX_BYTES // (n_workers * bytes_per_example))
+        return [slice(i, min(i + size, m)) for i in range(0, m, size)], n_workers
+
+    def _forward_sub_batches(self, A_prev_pad, f, stride, n_H, n_W):
+        """
+        Implements the linear part of the forward propagation with im2col, a few examples at a time in parallel threads
+        (numpy releases the GIL inside the GEMMs)
 
-                        #Get the 3d slice of the example i at the current position (h, w)
-                        a_slice_prev = A_prev_pad_i[vert_start:vert_end, horiz_start:horiz_end, :]
+        Arguments:
+        A_prev_pad -- padded input, numpy array of shape (m, n_H_prev + 2*pad, n_W_prev + 2*pad, n_C_prev)
+        f -- size of the convolving kernel
+        stride -- stride of the convolution
+        n_H, n_W -- dimensions of the output volume
 
-                        #Convolve the (3D) slice with the correct filter W and bias b, to get back one output neuron.
-                        weights = self.W[:,:,:,c]       #(f, f, n_C_prev)
-                        biases = self.b[:,:,:,c]        #(1, 1, 1)
-                        Z[i, h, w, c] = self.conv_single_step(a_slice_prev, weights, biases)
-                        # Activation
-                        A[i, h, w, c] = self.ReLU(Z[i, h, w, c])
+        Returns:
+        Z -- conv output before the activation, numpy array of shape (m, n_H, n_W, n_C)
+        """
+        m, n_C_prev = A_prev_pad.shape[0], A_prev_pad.shape[3]
+        n_C = self.W.shape[0]
+        Wmat = self.W.reshape(n_C, -1)
+        Z = np.empty((m, n_H, n_W, n_C), dtype=np.result_type(A_prev_pad, Wmat))
 
+        def convolve(batch):
+            cols = self._im2col(A_prev_pad[batch], f, stride, n_H, n_W)
+            Z_batch = Z[batch].reshape(-1, n_C)  # contiguous view, written in place
+            np.dot(cols, Wmat.T, out=Z_batch)
+            Z_batch += self.b.reshape(1, n_C)
 
-        # Save information in "cache" for the backprop
-        conv_cache = (A_prev, self.W.copy(), self.b.copy(), self.hparameters.copy())
-        activation_cache = Z
+        batches, n_workers = self._sub_batches(m, n_H * n_W * f * f * n_C_prev * A_prev_pad.itemsize)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            list(executor.map(convolve, batches))
 
-        return A, (conv_cache, activation_cache)
+        return Z
 
 
     def backward(self, dA, cache):
@@ -330,21 +542,22 @@ class Conv2d:
         dA_prev -- gradient of the cost with respect to the input of the conv layer (A_prev),
                 numpy array of shape (m, n_H_prev, n_W_prev, n_C_prev)
         dW -- gradient of the cost with respect to the weights of the conv layer (W)
-            numpy array of shape (f, f, n_C_prev, n_C)
+            numpy array of shape (n_C, n_C_prev, f, f)
         db -- gradient of the cost with respect to the biases of the conv layer (b)
             numpy array of shape (1, 1, 1, n_C)
         """    
         
         # Retrieve information from "cache"
         (conv_cache, activation_cache) = cache
-        Z = activation_cache
-        dA = dA.reshape(Z.shape)
-        dZ = dA * (Z > 0)  # ReLU derivative: 1 if Z > 0, else 0
+        packed_mask, shape = activation_cache
+        mask = self.xp.unpackbits(packed_mask)[:int(np.prod(shape))].reshape(shape).view(bool)
+        dA = dA.reshape(shape)
+        dZ = dA * mask  # ReLU derivative: 1 if Z > 0, else 0
 
-        A_prev, W, b, hparameters = conv_cache
+        A_prev, W, b, hparameters, cols = conv_cache
         
         (m, n_H_prev, n_W_prev, n_C_prev) = A_prev.shape         # Retrieve dimensions from A_prev's shape
-        (f, f, n_C_prev, n_C) = W.shape         # Retrieve dimensions from W's shape
+        (n_C, n_C_prev, f, f) = W.shape         # Retrieve dimensions from W's shape
         
         stride = hparameters["stride"]
         pad = hparameters["pad"]
@@ -359,69 +572,119 @@ class Conv2d:
         
         (m, n_H, n_W, n_C) = dA.shape  # Retrieve dimensions from dA's shape
 
-        # Initialize dA_prev, dW, db 
-        dA_prev = np.zeros((m, n_H_prev, n_W_prev, n_C_prev))                         
-        dW = np.zeros((f, f, n_C_prev, n_C)) 
-        db = np.zeros((1, 1, 1, n_C)) 
-        
-        # Pad A_prev and dA_prev
-        A_prev_pad = self.zero_pad(A_prev, pad)
-        dA_prev_pad = self.zero_pad(dA_prev, pad)
-        
-        for i in range(m):  # loop over the training examples
-            
-            #ith example from A_prev_pad and dA_prev_pad
-            a_prev_pad_i = A_prev_pad[i]
-            da_prev_pad_i = dA_prev_pad[i]
-            
-            for h in range(n_H):                   # loop over vertical axis of the output volume
-                vert_start = h * stride
-                vert_end = h * stride + f
-                for w in range(n_W):               # loop over horizontal axis of the output volume
-                    horiz_start = w * stride
-                    horiz_end = w * stride + f
-                    for c in range(n_C):           # loop over the channels of the output volume
-                        
-                        #define the slice from a_prev_pad
-                        a_slice = a_prev_pad_i[vert_start:vert_end, horiz_start:horiz_end, :]
-
-                        #Update gradients for the window and the filter's parameters
-
-                        #formula for computing 𝑑𝐴 with respect to the cost for a certain filter 𝑊𝑐 and a given training example
-                        da_prev_pad_i[vert_start:vert_end, horiz_start:horiz_end, :] += W[:,:,:,c] * dZ[i, h, w, c] 
-                        dW[:,:,:,c] += a_slice * dZ[i, h, w, c]  #formula for computing dw (derivative of one filter 𝑊𝑐 with respect to loss)
-                        db[:,:,:,c] += dZ[i, h, w, c] #formula for computing db (derivative of one filter 𝑊𝑐 with respect to loss)
-                        
-            #Set the ith training example's dA_prev to the unpadded da_prev_pad
-            if pad == 0:
-                dA_prev[i, :, :, :] = da_prev_pad_i
-            else:  
-                dA_prev[i, :, :, :] = da_prev_pad_i[pad:-pad, pad:-pad, :]
-        
+        if cols is None:
+            # forward() did not unroll the slices (Winograd path or loop kernel)
+            A_prev_pad = self.zero_pad(A_prev, pad)
+            if self.device == 'cpu' and m * n_H * n_W * f * f * n_C_prev * A_prev_pad.itemsize > self.IM2COL_MAX_BYTES:
+                # same dispatch as forward()
+                if numba is not None and n_H * n_W * f * f * n_C_prev * A_prev_pad.itemsize > self.IM2COL_MAX_BYTES:
+                    dA_prev_pad, dW, db = _conv_backward_nb(A_prev_pad, W, dZ, stride)
+                else:
+                    dA_prev_pad, dW, db = self._backward_sub_batches(A_prev_pad, W, dZ, stride)
+                return dA_prev_pad[:, pad:pad + n_H_prev, pad:pad + n_W_prev, :], dW, db
+            cols = self._im2col(A_prev_pad, f, stride, n_H, n_W)
+
+        dA_prev_pad, dW, db = self._backward_im2col(cols, W, dZ, (m, n_H_prev + 2 * pad, n_W_prev + 2 * pad, n_C_prev), stride)
+
+        #Set dA_prev to the unpadded dA_prev_pad
+        dA_prev = dA_prev_pad[:, pad:pad + n_H_prev, pad:pad + n_W_prev, :]
+
         return dA_prev, dW, db
 
+    def _backward_im2col(self, cols, W, dZ, pad_shape, stride):
+        """
+        Implements the backward propagation of the linear part of the convolution from the unrolled slices
+
+        Arguments:
+        cols -- unrolled slices of the padded input, output of _im2col(), shape (m*n_H*n_W, n_C_prev*f*f)
+        W -- Weights, numpy array of shape (n_C, n_C_prev, f, f)
+        dZ -- gradient of the cost with respect to the conv output before the activation, shape (m, n_H, n_W, n_C)
+        pad_shape -- shape of the padded input (m, n_H_prev + 2*pad, n_W_prev + 2*pad, n_C_prev)
+        stride -- stride of the convolution
+
+        Returns:
+        dA_prev_pad -- gradient of the cost with respect to the padded input, shape pad_shape
+        dW -- gradient of the cost with respect to W, shape (n_C, n_C_prev, f, f)
+        db -- gradient of the cost with respect to b, shape (1, 1, 1, n_C)
+        """
+        (m, n_H, n_W, n_C) = dZ.shape
+        (n_C, n_C_prev, f, f) = W.shape
+
+        # Flatten the gradient so that each row matches a row of cols: (m*n_H*n_W, n_C)
+        dZ_flat = dZ.reshape(-1, n_C)
+
+        # dW and db are reductions over every slice of every example (one GEMM for dW)
+        dW = self.xp.dot(dZ_flat.T, cols).reshape(n_C, n_C_prev, f, f)
+        db = dZ_flat.sum(axis=0).reshape(1, 1, 1, n_C)
+
+        # Gradient with respect to each unrolled slice: (m, n_H, n_W, n_C_prev, f, f)
+        dcols = self.xp.dot(dZ_flat, W.reshape(n_C, -1)).reshape(m, n_H, n_W, n_C_prev, f, f)
+
+        # col2im: slices overlap when stride < f, so accumulate one kernel position at a time
+        dA_prev_pad = self.xp.zeros(pad_shape, dtype=dcols.dtype)
+        for kh in range(f):
+            for kw in range(f):
+                dA_prev_pad[:, kh:kh + stride * n_H:stride, kw:kw + stride * n_W:stride, :] += dcols[:, :, :, :, kh, kw]
+
+        return dA_prev_pad, dW, db
+
+    def _backward_sub_batches(self, A_prev_pad, W, dZ, stride):
+        """
+        Implements the backward propagation of the linear part of the convolution with im2col,
+        a few examples at a time in parallel threads
+
+        Arguments:
+        A_prev_pad -- padded input, numpy array of shape (m, n_H_prev + 2*pad, n_W_prev + 2*pad, n_C_prev)
+        W -- Weights, numpy array of shape (n_C, n_C_prev, f, f)
+        dZ -- gradient of the cost with respect to the conv output before the activation, shape (m, n_H, n_W, n_C)
+        stride -- stride of the convolution
+
+        Returns:
+        dA_prev_pad, dW, db -- as returned by _backward_im2col()
+        """
+        (m, n_H, n_W, n_C) = dZ.shape
+        (n_C, n_C_prev, f, f) = W.shape
+        dA_prev_pad = np.empty(A_prev_pad.shape, dtype=dZ.dtype)
+
+        def backprop(batch):
+            cols = self._im2col(A_prev_pad[batch], f, stride, n_H, n_W)
+            # every sub-batch owns its examples of dA_prev_pad, dW and db are per-thread partial sums
+            dA_prev_pad[batch], dW_batch, db_batch = self._backward_im2col(cols, W, dZ[batch], A_prev_pad[batch].shape, stride)
+            return dW_batch, db_batch
+
+        # every worker holds both cols and dcols, which have the same size
+        batches, n_workers = self._sub_batches(m, 2 * n_H * n_W * f * f * n_C_prev * A_prev_pad.itemsize)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            partial_sums = list(executor.map(backprop, batches))
+
+        dW = sum(dW_batch for dW_batch, _ in partial_sums)
+        db = sum(db_batch for _, db_batch in partial_sums)
+        return dA_prev_pad, dW, db
+
 
 class Pooling:
 
-    def __init__(self, f, stride, mode = 'max'):
+    def __init__(self, f, stride, mode = 'max', device='cpu'):
 
         self.hparameters = {"f":f ,"stride": stride}
         self.mode = mode
+        self.xp = get_array_module(device)
 
         assert self.mode in ['max', 'average']
     
-    def forward(self, A_prev):
+    def forward(self, A_prev, training=True):
         """
         Implements the forward pass of the pooling layer
         
         Arguments:
         A_prev -- Input data, numpy array of shape (m, n_H_prev, n_W_prev, n_C_prev)
+        training -- whether backward() will be called on the output, the max mask is only computed if so. Default: True
         hparameters -- python dictionary containing "f" and "stride"
         mode -- the pooling mode defined as a string ("max" or "average")
         
         Returns:
         A -- output of the pool layer, a numpy array of shape (m, n_H, n_W, n_C)
-        cache -- cache used in the backward pass of the pooling layer, contains the input and hparameters 
+        cache -- cache used in the backward pass of the pooling layer, contains the input, hparameters and max mask
         """
         
         # Retrieve dimensions from the input shape
@@ -436,31 +699,21 @@ class Pooling:
         n_W = int(1 + (n_W_prev - f) / stride)
         n_C = n_C_prev
         
-        # Initialize output matrix A
-        A = np.zeros((m, n_H, n_W, n_C))              
-        
-        for i in range(m):                         # loop over the training examples
-            for h in range(n_H):                     # loop on the vertical axis of the output volume
-                #Find the vertical start and end of the current "slice"
-                vert_start = h*stride
-                vert_end = h*stride + f
-                for w in range(n_W):                 # loop on the horizontal axis
-                    #Find the horizontal start and end of the current "slice"
-                    horiz_start = w*stride
-                    horiz_end = w*stride + f
-                    for c in range (n_C):            # loop over the channels 
-                        # Get current slide on the ith training example of A_prev, channel c
-                        a_prev_slice = A_prev[i, vert_start:vert_end, horiz_start:horiz_end, c]  
-                        
-                        #Compute the pooling operation on the slice. 
-                        if self.mode == "max":
-                            A[i, h, w, c] = np.max(a_prev_slice)
-                        elif self.mode == "average":
-                            A[i, h, w, c] = np.mean(a_prev_slice)
-        
+        # View of all the pooling windows, shape (m, n_H, n_W, f, f, n_C), no data is copied here
+        s0, s1, s2, s3 = A_prev.strides
+        windows = as_strided_readonly(self.xp, A_prev, (m, n_H, n_W, f, f, n_C), (s0, stride * s1, stride * s2, s1, s2, s3))
+
+        #Compute the pooling operation on every window at once
+        if self.mode == "max":
+            A = windows.max(axis=(3, 4))
+            # Position(s) of the maximum in each window, reused by backward()
+            mask = windows == A[:, :, :, None, None, :] if training else None
+        elif self.mode == "average":
+            A = windows.mean(axis=(3, 4))
+            mask = None
         
-        # Store the input and hparameters in "cache" for pool_backward()
-        cache = (A_prev, self.hparameters.copy())
+        # Store the input, hparameters and max mask in "cache" for pool_backward()
+        cache = (A_prev, self.hparameters.copy(), mask)
         
         return A, cache
 
@@ -470,14 +723,14 @@ class Pooling:
         
         Arguments:
         dA -- gradient of cost with respect to the output of the pooling layer, same shape as A
-        cache -- cache output from the forward pass of the pooling layer, contains the layer's input and hparameters 
+        cache -- cache output from the forward pass of the pooling layer, contains the layer's input, hparameters and max mask
         mode -- the pooling mode you would like to use, defined as a string ("max" or "average")
         
         Returns:
         dA_prev -- gradient of cost with respect to the input of the pooling layer, same shape as A_prev
         """
         # Retrieve information from cache
-        (A_prev, hparameters) = cache
+        (A_prev, hparameters, mask) = cache
         
         f = hparameters["f"]
         stride = hparameters["stride"]
@@ -486,74 +739,56 @@ class Pooling:
         m, n_H_prev, n_W_prev, n_C_prev = A_prev.shape
         m, n_H, n_W, n_C = dA.shape
         
-        # Initialize dA_prev
-        dA_prev = np.zeros(A_prev.shape)
-        
-        for i in range(m): # loop over the training examples
-            
-            a_prev_i = A_prev[i] #training example from A_prev 
-            
-            for h in range(n_H):                   # loop on the vertical axis
-                vert_start = h*stride
-                vert_end = h*stride + f
-                for w in range(n_W):               # loop on the horizontal axis
-                    horiz_start = w*stride
-                    horiz_end = w*stride + f
-                    for c in range(n_C):           # loop over the channels (depth)
-
-                        #Compute the backward propagation in both modes.
-                        if self.mode == "max":
-                            
-                            #Use the corners and "c" to define the current slice from a_prev
-                            a_prev_slice =  a_prev_i[vert_start:vert_end, horiz_start:horiz_end, c] 
-
-                            # Only the maximum value in each pooling window influences the output.
-                            # We use a mask to determine which element in the input slice was selected as max.
-                            # We assign the gradient only to that max value in dA_prev.
-                                                        
-                            mask = (a_prev_slice == np.max(a_prev_slice))
-                            mask /= np.sum(mask)  # Normalize the mask when multiple elements are equal
-
-                            #Set dA_prev to be dA_prev + (the mask multiplied by the correct entry of dA)
-                            dA_prev[i, vert_start: vert_end, horiz_start: horiz_end, c] += dA[i, h, w, c] * mask
-                            
-                        elif self.mode == "average":
-                            
-                            #Get the value da from dA (≈1 line)
-                            da = dA[i, h, w, c]
-
-                            #Distribute it to get the correct slice of dA_prev. i.e. Add the distributed value of da.
-
-                            #Each element in the input pooling window equally influences the output.
-                            #The gradient is evenly distributed across all elements in the pooling region.
-                            average = da / (f * f)
-                            dA_prev[i, vert_start: vert_end, horiz_start: horiz_end, c] += average # broadcasted to fxf
+        #Gradient with respect to every element of every window, shape (m, n_H, n_W, f, f, n_C)
+        if self.mode == "max":
+            # Only the maximum value(s) of each window influence the output, split the gradient evenly between ties
+            dwindows = mask * (dA / mask.sum(axis=(3, 4), dtype=dA.dtype))[:, :, :, None, None, :]
+        elif self.mode == "average":
+            # Each element of the window equally influences the output
+            dwindows = self.xp.broadcast_to((dA / (f * f))[:, :, :, None, None, :], (m, n_H, n_W, f, f, n_C))
+
+        dA_prev = self.xp.zeros(A_prev.shape, dtype=dwindows.dtype)
+        if stride >= f:
+            # Windows do not overlap: write all of them at once through a window view of dA_prev
+            s0, s1, s2, s3 = dA_prev.strides
+            dA_prev_windows = self.xp.lib.stride_tricks.as_strided(dA_prev, shape=(m, n_H, n_W, f, f, n_C),
+                                                                   strides=(s0, stride * s1, stride * s2, s1, s2, s3))
+            dA_prev_windows[...] = dwindows
+        else:
+            # Windows overlap, so accumulate one window offset at a time
+            for kh in range(f):
+                for kw in range(f):
+                    dA_prev[:, kh:kh + stride * n_H:stride, kw:kw + stride * n_W:stride, :] += dwindows[:, :, :, kh, kw, :]
         
         return dA_prev
     
 
 class FullyConnected:
-    def __init__(self, input_dim, output_dim):
+    def __init__(self, input_dim, output_dim, dtype=np.float32, device='cpu'):
         self.input_dim = input_dim #(n_x)
         self.output_dim = output_dim #(n_y)
-        self.W = np.random.randn(self.output_dim, self.input_dim) * np.sqrt(1. / self.input_dim)  # shape: (n_y, n_x)
-        self.b = np.zeros((self.output_dim, 1)) # shape: (n_y, 1)
+        self.xp = get_array_module(device)
+        self.W = self.xp.asarray(np.random.randn(self.output_dim, self.input_dim) * np.sqrt(1. / self.input_dim), dtype=dtype)  # shape: (n_y, n_x)
+        self.b = self.xp.zeros((self.output_dim, 1), dtype=dtype) # shape: (n_y, 1)
 
-        self.W_m, self.W_v = np.zeros_like(self.W), np.zeros_like(self.W)
-        self.b_m, self.b_v = np.zeros_like(self.b), np.zeros_like(self.b)
-    @staticmethod
-    def softmax(x):
-        '''Softmax activation function with cache'''
-        exps = np.exp(x - np.max(x)) #subtracting max(x) to avoid numerical instability
-        return exps / np.sum(exps, axis=0)
+        self.W_m, self.W_v = self.xp.zeros_like(self.W), self.xp.zeros_like(self.W)
+        self.b_m, self.b_v = self.xp.zeros_like(self.b), self.xp.zeros_like(self.b)
+
+    def softmax(self, x):
+        '''Softmax activation function, computed in place in a single output array'''
+        exps = self.xp.empty_like(x)
+        self.xp.subtract(x, x.max(axis=0, keepdims=True), out=exps) #subtracting max(x) to avoid numerical instability
+        self.xp.exp(exps, out=exps)
+        exps /= exps.sum(axis=0, keepdims=True)
+        return exps
 
     def forward_linear(self, A):
         '''Forward pass through the
         linear layer'''
-        Z = np.dot(self.W, A) + self.b  # shape: (n_y, m) = (n_y, n_x) * (n_x, m) + (n_y, 1)
+        Z = self.xp.dot(self.W, A) + self.b  # shape: (n_y, m) = (n_y, n_x) * (n_x, m) + (n_y, 1)
 
-        W , b = self.W.copy(), self.b.copy()
-        linear_cache = (A, W, b)
+        # the parameters are only updated after backward, so the cache keeps references instead of copies
+        linear_cache = (A, self.W, self.b)
         return Z, linear_cache
 
     def forward_activation(self, Z):
@@ -603,11 +838,88 @@ class FullyConnected:
         Z = activation_cache  # Z is not used for softmax 
 
         dAL = AL - Y  # Gradient of loss w.r.t softmax output
-        dW = np.dot(dAL, X.T) / m  # Gradient of weights 
-        db = np.sum(dAL, axis=1, keepdims=True) / m  # Gradient of biases
-        dA_prev = np.dot(W.T, dAL)  # Gradient for previous layer
+        dW = self.xp.dot(dAL, X.T) / m  # Gradient of weights 
+        db = self.xp.sum(dAL, axis=1, keepdims=True) / m  # Gradient of biases
+        dA_prev = self.xp.dot(W.T, dAL)  # Gradient for previous layer
 
         return dA_prev, dW, db
 
 
-
+# Loop kernels used by Conv2d when the unrolled im2col matrix of a single example would not fit in memory.
+# They only take ndarrays and scalars so that numba can compile them; the batch loop is run in parallel.
+
+def _njit(func):
+    """Compile func with numba when it is installed, otherwise return it unchanged"""
+    if numba is None:
+        return func
+    return numba.njit(parallel=True, fastmath=True, cache=True)(func)
+
+
+_prange = range if numba is None else numba.prange
+
+
+@_njit
+def _conv_forward_nb(A_prev_pad, Wflat, b, f, stride, n_H, n_W):
+    """Direct convolution of A_prev_pad (m, n_H_prev, n_W_prev, n_C_prev) with the flattened filters
+    Wflat (n_C_prev*f*f, n_C) and the biases b (n_C,), returns Z"""
+    m, n_C_prev = A_prev_pad.shape[0], A_prev_pad.shape[3]
+    n_C = Wflat.shape[1]
+    Z = np.zeros((m, n_H, n_W, n_C), dtype=A_prev_pad.dtype)
+
+    for i in _prange(m):               # loop training examples
+        for h in range(n_H):           # loop over vertical axis of the output volume
+            vert_start = h * stride
+            for w in range(n_W):       # loop over horizontal axis of the output volume
+                horiz_start = w * stride
+                Z[i, h, w, :] = b
+                # Convolve the slice with all the filters at once: the channel loop is innermost and contiguous
+                k = 0
+                for c_prev in range(n_C_prev):
+                    for kh in range(f):
+                        for kw in range(f):
+                            a = A_prev_pad[i, vert_start + kh, horiz_start + kw, c_prev]
+                            for c in range(n_C):
+                                Z[i, h, w, c] += a * Wflat[k, c]
+                            k += 1
+
+    return Z
+
+
+@_njit
+def _conv_backward_nb(A_prev_pad, W, dZ, stride):
+    """Direct convolution backward pass with W (n_C, n_C_prev, f, f), returns dA_prev_pad, dW, db"""
+    m = A_prev_pad.shape[0]
+    n_C, n_C_prev, f = W.shape[0], W.shape[1], W.shape[2]
+    n_H, n_W = dZ.shape[1], dZ.shape[2]
+    dA_prev_pad = np.zeros(A_prev_pad.shape, dtype=A_prev_pad.dtype)
+    dW = np.zeros(W.shape, dtype=W.dtype)
+    db = np.zeros((1, 1, 1, n_C), dtype=W.dtype)
+
+    # Every example writes to its own slice of dA_prev_pad, so the batch loop can run in parallel
+    for i in _prange(m):
+        for h in range(n_H):
+            vert_start = h * stride
+            for w in range(n_W):
+                horiz_start = w * stride
+                for c in range(n_C):
+                    dz = dZ[i, h, w, c]
+                    for c_prev in range(n_C_prev):
+                        for kh in range(f):
+                            for kw in range(f):
+                                dA_prev_pad[i, vert_start + kh, horiz_start + kw, c_prev] += W[c, c_prev, kh, kw] * dz
+
+    # dW and db are summed over the whole batch, so parallelize over the filters instead
+    for c in _prange(n_C):
+        for i in range(m):
+            for h in range(n_H):
+                vert_start = h * stride
+                for w in range(n_W):
+                    horiz_start = w * stride
+                    dz = dZ[i, h, w, c]
+                    db[0, 0, 0, c] += dz
+                    for c_prev in range(n_C_prev):
+                        for kh in range(f):
+                            for kw in range(f):
+                                dW[c, c_prev, kh, kw] += A_prev_pad[i, vert_start + kh, horiz_start + kw, c_prev] * dz
+
+    return dA_prev_pad, dW, db